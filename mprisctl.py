@@ -1,101 +1,225 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import sys
+import json
+import time
+import tempfile
 import argparse
+from types import SimpleNamespace
 
 import dbus
+import dbus.connection
 from dbus.mainloop.glib import DBusGMainLoop
 from gi.repository import GLib
 
 DBusGMainLoop(set_as_default=True)
 
+NAME_OWNER_CHANGED_RULE = \
+    "type='signal'," \
+    "sender='org.freedesktop.DBus'," \
+    "interface='org.freedesktop.DBus'," \
+    "member='NameOwnerChanged'," \
+    "path='/org/freedesktop/DBus'," \
+    "arg0namespace='org.mpris.MediaPlayer2'"
+
+# Seconds for which a rendered status is reused by the status command
+STATUS_CACHE_TTL = 1.0
+
+PLAYER_METHODS = {
+    'previous': 'Previous',
+    'next': 'Next',
+    'play': 'Play',
+    'pause': 'Pause',
+    'playpause': 'PlayPause',
+    'stop': 'Stop'
+}
+
+
+class FormatTemplate:
+    """Represents a status format string, parsed once into tokens."""
+
+    TAG_NAMES = ('title', 'artist', 'album')
+    BLOCK_NAMES = ('playing', 'paused')
+
+    # Only known markers match, so anything else is left as a literal
+    MARKER_PATTERN = re.compile(
+        r'\{\{(?:('
+        + '|'.join(map(re.escape, TAG_NAMES))
+        + r')|(/?)('
+        + '|'.join(map(re.escape, BLOCK_NAMES))
+        + r'))\}\}'
+    )
+
+    def __init__(self, format_string):
+        self.format_string = format_string
+
+        # List of (kind, value) pairs, where kind is one of 'lit', 'tag',
+        # 'block_open' or 'block_close'
+        self.tokens = []
+
+        # Index of each block_open token mapped to its block_close token
+        self.block_ends = {}
+
+        # Tokens with blocks already resolved for each playback state
+        self.playing_tokens = []
+        self.paused_tokens = []
+
+        self.compile()
+
+    def compile(self):
+        open_blocks = {}
+        last_pos = 0
+
+        for match in FormatTemplate.MARKER_PATTERN.finditer(self.format_string):
+            if match.start() > last_pos:
+                self.tokens.append(
+                    ('lit', self.format_string[last_pos:match.start()])
+                )
+            last_pos = match.end()
+
+            tag_name, is_closing, name = match.groups()
+            if tag_name:
+                self.tokens.append(('tag', tag_name))
+            elif is_closing:
+                if name in open_blocks:
+                    self.block_ends[open_blocks.pop(name)] = len(self.tokens)
+                self.tokens.append(('block_close', name))
+            elif name not in open_blocks:
+                open_blocks[name] = len(self.tokens)
+                self.tokens.append(('block_open', name))
+
+        if last_pos < len(self.format_string):
+            self.tokens.append(('lit', self.format_string[last_pos:]))
+
+        # Unterminated blocks extend to the end of the format string
+        for index in open_blocks.values():
+            self.block_ends[index] = len(self.tokens) - 1
+
+        # The format string never changes, so resolve the blocks for both
+        # playback states up front and leave only tags to fill in
+        self.playing_tokens = self.resolve('paused')
+        self.paused_tokens = self.resolve('playing')
+
+    def resolve(self, hidden_block):
+        result = []
+
+        index = 0
+        while index < len(self.tokens):
+            kind, value = self.tokens[index]
+
+            if kind == 'block_open' and value == hidden_block:
+                index = self.block_ends[index]
+            elif kind == 'lit' and result and result[-1][0] == 'lit':
+                result[-1] = ('lit', result[-1][1] + value)
+            elif kind in ('lit', 'tag'):
+                result.append((kind, value))
+
+            index += 1
+
+        return result
+
+    def render(self, metadata: dict, is_playing: bool):
+        if is_playing:
+            tokens = self.playing_tokens
+        else:
+            tokens = self.paused_tokens
+
+        return ''.join(
+            metadata[value] if kind == 'tag' else value
+            for kind, value in tokens
+        )
+
 
 class MPRISPlayer:
     """Represents an MPRIS-compatible player."""
 
-    def __init__(self, bus_name, session_bus, format_string):
+    def __init__(self, bus_name, session_bus, template):
         # User-provided fields
         self.session_bus = session_bus
         self.bus_name = bus_name
-        self.format_string = format_string
+        self.template = template
 
         # D-Bus related fields
         self.proxy_object = self.session_bus.get_object(
             bus_name,
-            '/org/mpris/MediaPlayer2'
+            '/org/mpris/MediaPlayer2',
+            follow_name_owner_changes=True
         )
         self.properties_interface = dbus.Interface(
             self.proxy_object,
             'org.freedesktop.DBus.Properties'
         )
-        self.player_interface = dbus.Interface(
-            self.proxy_object,
-            'org.mpris.MediaPlayer2.Player'
-        )
+
+        # Bound D-Bus method, resolved once instead of on every call
+        self._get_all = self.properties_interface.get_dbus_method("GetAll")
 
         # Connection to signal
         self.connection = None
 
-        # Player metadata
-        self.is_playing = None
-        self.metadata = {
-            'title': "",
-            'artist': [],
-            'album': ""
-        }
-
-        # D-Bus seems to send multiple signals when properties are changed,
-        # so let's fix that
-        self.prev_content = None
-
-        # Initialize metadata
-        self.update_status()
+        # Player metadata and render state
+        self.reset()
 
     # D-Bus method wrappers
 
-    def play(self):
-        (self.player_interface.get_dbus_method("Play"))()
-
-    def pause(self):
-        (self.player_interface.get_dbus_method("Pause"))()
-
-    def playpause(self):
-        (self.player_interface.get_dbus_method("PlayPause"))()
-
-    def stop(self):
-        (self.player_interface.get_dbus_method("Stop"))()
-
-    def previous(self):
-        (self.player_interface.get_dbus_method("Previous"))()
-
-    def next(self):
-        (self.player_interface.get_dbus_method("Next"))()
-
-    def get(self, interface, target):
-        return (self.properties_interface.get_dbus_method("Get"))(interface, target)
+    def get_all(self, interface, **kwargs):
+        # Accepts reply_handler and error_handler for asynchronous calls
+        return self._get_all(interface, **kwargs)
 
     # D-Bus signal handler
 
     def on_PropertiesChanged(self, interface, changed_props, invalid_props):
-        if interface == self.player_interface.dbus_interface:
-
-            updated = self.update_status(changed_props)
+        updated = self.update_status(changed_props)
 
-            if updated:
+        if updated:
+            fingerprint = self.fingerprint()
+            if fingerprint != self.prev_fingerprint:
+                self.prev_fingerprint = fingerprint
                 self.print_status()
 
     # Helper function
 
     def connect(self):
-        self.connection = self.proxy_object.connect_to_signal(
-            'PropertiesChanged',
-            self.on_PropertiesChanged
+        # Let the bus drop changes to other interfaces, such as the root
+        # MediaPlayer2 interface, before they ever reach us
+        self.connection = self.session_bus.add_signal_receiver(
+            self.on_PropertiesChanged,
+            signal_name='PropertiesChanged',
+            dbus_interface='org.freedesktop.DBus.Properties',
+            bus_name=self.bus_name,
+            path='/org/mpris/MediaPlayer2',
+            arg0='org.mpris.MediaPlayer2.Player'
         )
 
     def disconnect(self):
         self.connection.remove()
 
+    def reset(self):
+        # Player metadata, coerced to plain strings on ingest
+        self.is_playing = None
+        self.metadata = {
+            'title': "",
+            'artist': "",
+            'album': ""
+        }
+
+        # D-Bus seems to send multiple signals when properties are changed,
+        # so let's fix that by remembering the hash of the last printed status
+        self.prev_hash = None
+
+        # Most of those signals don't change anything that is displayed, so
+        # skip rendering entirely when the displayed fields are unchanged
+        self.prev_fingerprint = None
+
+    def fingerprint(self):
+        return (
+            self.metadata['title'],
+            self.metadata['artist'],
+            self.metadata['album'],
+            self.is_playing
+        )
+
     def update_status(self, changed_props=None):
         if changed_props:
 
@@ -103,147 +227,209 @@ class MPRISPlayer:
             if 'Position' in changed_props:
                 return False
 
+            changed = False
+
             # If metadata is changed
             if 'Metadata' in changed_props:
-                for key in changed_props['Metadata'].keys():
+                for key, raw_value in changed_props['Metadata'].items():
                     normal_key = key[6:]
-                    if normal_key in self.metadata.keys() \
-                       and self.metadata[normal_key] != changed_props['Metadata'][key]:
-                        self.metadata[normal_key] = changed_props['Metadata'][key]
+                    if normal_key not in self.metadata:
+                        continue
 
-                        return True
+                    value = _coerce(raw_value)
+                    if self.metadata[normal_key] != value:
+                        self.metadata[normal_key] = value
+                        changed = True
 
             # If playback status is changed
             if 'PlaybackStatus' in changed_props:
-                if changed_props['PlaybackStatus'] == 'Playing':
-                    self.is_playing = True
-                elif changed_props['PlaybackStatus'] == 'Paused':
-                    self.is_playing = False
-                else:
-                    self.is_playing = None
-
-                return True
+                self.set_playback_status(changed_props['PlaybackStatus'])
+                changed = True
 
-            return False
+            return changed
 
         else:
             try:
-                raw_metadata = self.get(
-                    'org.mpris.MediaPlayer2.Player',
-                    'Metadata'
-                )
-                for key in self.metadata.keys():
-                    if 'xesam:' + key in raw_metadata:
-                        self.metadata[key] = raw_metadata['xesam:' + key]
-                    else:
-                        self.metadata[key] = ''
-
-                playback = self.get(
-                    'org.mpris.MediaPlayer2.Player',
-                    'PlaybackStatus'
+                self.apply_properties(
+                    self.get_all('org.mpris.MediaPlayer2.Player')
                 )
-                if playback == 'Playing':
-                    self.is_playing = True
-                elif playback == 'Paused':
-                    self.is_playing = False
-                else:
-                    self.is_playing = None
-
                 return True
 
             except dbus.DBusException:
                 print("METADATA UNAVAILABLE")
                 return False
 
-    def print_status(self):
-
-        result = replace_tag(self.format_string, self.metadata)
-
-        if self.is_playing:
-            result = replace_block(result, 'playing')
-            result = replace_block(result, 'paused', '')
-        else:
-            result = replace_block(result, 'playing', '')
-            result = replace_block(result, 'paused')
-
-        if result != self.prev_content:
-            print_always(result)
-            self.prev_content = result
-
+    def update_status_async(self, callback):
+        # dbus-python swallows exceptions raised in reply handlers, so always
+        # report back, or whoever waits on the callback would hang forever
+        def on_reply(properties):
+            updated = False
+            try:
+                self.apply_properties(properties)
+                updated = True
+            finally:
+                callback(updated)
 
-class NonePlayer(MPRISPlayer):
+        def on_error(error):
+            try:
+                print("METADATA UNAVAILABLE")
+            finally:
+                callback(False)
 
-    def __init__(self):
-        pass
+        self.get_all(
+            'org.mpris.MediaPlayer2.Player',
+            reply_handler=on_reply,
+            error_handler=on_error
+        )
 
-    # D-Bus method wrappers
+    def apply_properties(self, properties):
+        raw_metadata = properties.get('Metadata', {})
+        for key in self.metadata:
+            if 'xesam:' + key in raw_metadata:
+                self.metadata[key] = _coerce(raw_metadata['xesam:' + key])
+            else:
+                self.metadata[key] = ''
 
-    def play(self):
-        pass
+        self.set_playback_status(properties.get('PlaybackStatus'))
 
-    def pause(self):
-        pass
+    def set_playback_status(self, playback):
+        if playback == 'Playing':
+            self.is_playing = True
+        elif playback == 'Paused':
+            self.is_playing = False
+        else:
+            self.is_playing = None
 
-    def playpause(self):
-        pass
+    def render(self):
+        return self.template.render(self.metadata, self.is_playing)
 
-    def stop(self):
-        pass
+    def print_status(self):
 
-    def previous(self):
-        pass
+        result = self.render()
+        result_hash = hash(result)
 
-    def next(self):
-        pass
+        if result_hash != self.prev_hash:
+            print_always(result)
+            self.prev_hash = result_hash
 
-    def get(self, interface, target):
-        pass
 
-    # Helper function
+def _noop(*args, **kwargs):
+    return None
 
-    def connect(self):
-        pass
 
-    def disconnect(self):
-        pass
-
-    def print_status(self):
-        pass
+# Stands in for the primary player while no player is active
+NONE_PLAYER = SimpleNamespace(
+    bus_name=None,
+    is_playing=None,
+    connect=_noop,
+    disconnect=_noop,
+    render=_noop,
+    print_status=_noop
+)
 
 
 class MPRISManager:
     """Manages multiple MPRIS players."""
 
     def __init__(self, format_string):
-        self.format_string = format_string
+        self.template = FormatTemplate(format_string)
 
         self.session_bus = dbus.SessionBus()
 
         self.players = {}
-        self.primary_player = NonePlayer()
+        self.players_by_name = {}
+        self.primary_player = NONE_PLAYER
         self.populate_players()
         self.update_players()
 
-        self.session_bus.add_signal_receiver(
+        # D-Bus match rules can't prefix-match arg0 with plain `arg0`, but
+        # `arg0namespace` can, so install the rule by hand and register the
+        # handler on the plain connection to avoid a second, catch-all rule.
+        self.session_bus.add_match_string(NAME_OWNER_CHANGED_RULE)
+        dbus.connection.Connection.add_signal_receiver(
+            self.session_bus,
             self.on_NameOwnerChanged,
-            'NameOwnerChanged'
+            signal_name='NameOwnerChanged',
+            dbus_interface='org.freedesktop.DBus',
+            path='/org/freedesktop/DBus'
         )
 
     def populate_players(self):
-        for name in self.session_bus.list_names():
-            if MPRISManager.is_player_bus(name):
-                owner = self.session_bus.get_name_owner(name)
-                self.add_player(name, owner)
+        names = [
+            name for name in self.session_bus.list_names()
+            if name.startswith('org.mpris.MediaPlayer2')
+        ]
+        owners = {}
+        players = {}
+        fetched = set()
+
+        def on_reply(name, owner):
+            owners[name] = owner
+
+        # Send every GetNameOwner and GetAll request up front and wait for the
+        # replies together, instead of paying blocking round-trips per player
+        for name in names:
+            self.session_bus.call_async(
+                'org.freedesktop.DBus',
+                '/org/freedesktop/DBus',
+                'org.freedesktop.DBus',
+                'GetNameOwner',
+                's',
+                (name,),
+                lambda owner, name=name: on_reply(name, owner),
+                lambda error, name=name: on_reply(name, None)
+            )
+
+            players[name] = MPRISPlayer(
+                name,
+                self.session_bus,
+                self.template
+            )
+            players[name].update_status_async(
+                lambda updated, name=name: fetched.add(name)
+            )
+
+        wait_until(
+            lambda: len(owners) == len(names) and len(fetched) == len(names)
+        )
+
+        for name in names:
+            # The player may have quit since the names were listed
+            if owners[name]:
+                self.players_by_name[name] = players[name]
+                self.players[owners[name]] = players[name]
 
     def add_player(self, bus_name, owner):
-        self.players[owner] = MPRISPlayer(
-            bus_name,
-            self.session_bus,
-            self.format_string
-        )
+        player = self.players_by_name.get(bus_name)
+
+        if player is None:
+            player = MPRISPlayer(
+                bus_name,
+                self.session_bus,
+                self.template
+            )
+            self.players_by_name[bus_name] = player
+
+        # The proxy object and its signal connection follow the bus name,
+        # so a returning player only needs its status refreshed
+        player.update_status()
+
+        self.players[owner] = player
 
     def del_player(self, owner):
-        del self.players[owner]
+        player = self.players.pop(owner)
+
+        # Whatever process takes the name next starts from a clean slate
+        player.reset()
+
+        # Per-instance names, such as org.mpris.MediaPlayer2.vlc.instance7389,
+        # never come back, so only keep players whose name may be reused
+        if player.bus_name.rsplit('.', 1)[-1].startswith('instance'):
+            del self.players_by_name[player.bus_name]
+
+        if self.primary_player is player:
+            self.primary_player.disconnect()
+            self.primary_player = NONE_PLAYER
 
     def change_owner(self, old_owner, new_owner):
         temp = self.players[old_owner]
@@ -251,37 +437,29 @@ class MPRISManager:
         self.players[new_owner] = temp
 
     def update_players(self):
-        for _, player in self.players.items():
-            if isinstance(player.is_playing, bool):
-                if self.primary_player is player:
-                    return
-                else:
-                    self.primary_player.disconnect()
-                    self.primary_player = player
-                    self.primary_player.connect()
-                    return
-            else:
-                continue
+        player = first_active(
+            self.players.values(),
+            lambda player: isinstance(player.is_playing, bool)
+        )
 
-        print("NO ACTIVE PLAYERS")
+        if player is None:
+            print("NO ACTIVE PLAYERS")
+        elif self.primary_player is not player:
+            self.primary_player.disconnect()
+            self.primary_player = player
+            self.primary_player.connect()
 
     # D-Bus signal handler
 
     def on_NameOwnerChanged(self, name, old_owner, new_owner):
-        if MPRISManager.is_player_bus(name):
-            if not old_owner and new_owner:
-                self.add_player(name, old_owner)
-            elif not new_owner and old_owner:
-                self.del_player(old_owner)
-            else:
-                self.change_owner(old_owner, new_owner)
-            self.update_players()
-
-    # Helper function
-
-    @staticmethod
-    def is_player_bus(bus_name):
-        return bus_name.startswith('org.mpris.MediaPlayer2')
+        # Only MPRIS names get here thanks to NAME_OWNER_CHANGED_RULE
+        if not old_owner and new_owner:
+            self.add_player(name, new_owner)
+        elif not new_owner and old_owner:
+            self.del_player(old_owner)
+        else:
+            self.change_owner(old_owner, new_owner)
+        self.update_players()
 
 
 # Functions that don't belong anywhere
@@ -292,40 +470,126 @@ def print_always(content: str):
     sys.stdout.flush()
 
 
-def replace_tag(original: str, value_dict: dict):
-    result = original
-    for tag_name in value_dict.keys():
-        value = None
-        if isinstance(value_dict[tag_name], list):
-            value = value_dict[tag_name][0]
-        else:
-            value = value_dict[tag_name]
+def first_active(players, is_active):
+    # Shared by MPRISManager and one-shot commands so both pick the same player
+    return next((player for player in players if is_active(player)), None)
 
-        result = result.replace('{{' + tag_name + '}}', value)
 
-    return result
+def get_playback_status(session_bus, bus_name):
+    try:
+        return session_bus.call_blocking(
+            bus_name,
+            '/org/mpris/MediaPlayer2',
+            'org.freedesktop.DBus.Properties',
+            'Get',
+            'ss',
+            ('org.mpris.MediaPlayer2.Player', 'PlaybackStatus')
+        )
+    except dbus.DBusException:
+        return None
+
+
+def control_primary_player(method: str):
+    session_bus = dbus.SessionBus()
+
+    # ListNames order is the discovery order MPRISManager starts with, and
+    # players are only queried until the first active one is found
+    bus_name = first_active(
+        (
+            name for name in session_bus.list_names()
+            if name.startswith('org.mpris.MediaPlayer2')
+        ),
+        lambda name: get_playback_status(session_bus, name)
+        in ('Playing', 'Paused')
+    )
+
+    if bus_name is None:
+        print("NO ACTIVE PLAYERS")
+        return
+
+    session_bus.call_blocking(
+        bus_name,
+        '/org/mpris/MediaPlayer2',
+        'org.mpris.MediaPlayer2.Player',
+        method,
+        '',
+        ()
+    )
 
+    # The cached status most likely no longer matches the player
+    clear_status_cache()
 
-def replace_block(original: str, block_name: str, replace_str: str = None):
-    result = None
 
-    block_begin = '{{' + block_name + '}}'
-    block_end = '{{/' + block_name + '}}'
+def status_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') \
+        or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'mprisctl', 'state.json')
 
-    start_pos = original.find(block_begin)
-    end_pos = original.find(block_end)
 
-    if isinstance(replace_str, str):
-        result = \
-            original[:start_pos] \
-            + replace_str \
-            + original[end_pos + len(block_end):]
-    else:
-        result = original \
-            .replace(block_begin, '') \
-            .replace(block_end, '')
+def read_status_cache(format_string: str):
+    path = status_cache_path()
 
-    return result
+    try:
+        # A negative age means the clock went backwards since the write,
+        # so the cache can't be trusted to be recent
+        age = time.time() - os.stat(path).st_mtime
+        if not 0 <= age <= STATUS_CACHE_TTL:
+            return None
+
+        with open(path, 'r') as cache_file:
+            state = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+    # The cached status is only valid for the format it was rendered with
+    if not isinstance(state, dict) or state.get('format') != format_string:
+        return None
+
+    rendered = state.get('rendered')
+    return rendered if isinstance(rendered, str) else None
+
+
+def write_status_cache(format_string: str, rendered: str):
+    path = status_cache_path()
+    state = {
+        'format': format_string,
+        'rendered': rendered
+    }
+
+    # Write to a temporary file of our own first so concurrent pollers never
+    # read, or write into, a partially written cache
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(state, cache_file)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    except OSError:
+        pass
+
+
+def clear_status_cache():
+    try:
+        os.unlink(status_cache_path())
+    except OSError:
+        pass
+
+
+def wait_until(condition):
+    context = GLib.MainContext.default()
+    while not condition():
+        context.iteration(True)
+
+
+def _coerce(value) -> str:
+    # Multi-valued fields such as xesam:artist only display their first entry
+    if isinstance(value, (list, dbus.Array)):
+        return str(value[0]) if value else ''
+    return str(value)
 
 
 def main():
@@ -371,10 +635,25 @@ def main():
     )
     args = parser.parse_args()
 
+    # One-shot player commands don't need the signal machinery of the manager
+    if args.command in PLAYER_METHODS:
+        control_primary_player(PLAYER_METHODS[args.command])
+        return
+
+    # Pollers such as status bars call this repeatedly, so skip D-Bus entirely
+    # if the status was rendered very recently
+    if args.command == 'status':
+        rendered = read_status_cache(args.format)
+        if rendered is not None:
+            print_always(rendered)
+            return
+
     manager = MPRISManager(args.format)
 
     if args.command == 'status':
         manager.primary_player.print_status()
+        if manager.primary_player is not NONE_PLAYER:
+            write_status_cache(args.format, manager.primary_player.render())
 
     elif args.command == 'tail':
         manager.primary_player.print_status()
@@ -388,24 +667,6 @@ def main():
     elif args.command == 'scroll':
         pass
 
-    elif args.command == 'previous':
-        manager.primary_player.previous()
-
-    elif args.command == 'next':
-        manager.primary_player.next()
-
-    elif args.command == 'play':
-        manager.primary_player.play()
-
-    elif args.command == 'pause':
-        manager.primary_player.pause()
-
-    elif args.command == 'playpause':
-        manager.primary_player.playpause()
-
-    elif args.command == 'stop':
-        manager.primary_player.stop()
-
     elif args.command == 'help':
         parser.print_help()
 